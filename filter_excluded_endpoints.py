@@ -13,26 +13,52 @@
 Без аргумента - чтение из stdin. Результат выводится в stdout.
 """
 
+import contextlib
 import os
+import re
+import shutil
 import sys
+from collections.abc import Iterable
+from functools import lru_cache
 
+from lib.parsing import parse_proxy_url
+from lib.textio import read_blocks
 
+# Строка только из цифр, точек и двоеточий (IPv4 / IPv4:port / числовой IPv6)
+_IS_NUMERIC = re.compile(r"^[0-9.:]+$").match
+# Таблица для удаления точек одним проходом str.translate (без цепочки replace)
+_STRIP_DOTS = str.maketrans("", "", ".")
+
+# host:port из типичных URI прокси (userinfo@host:port); иначе (ss, vmess base64, ссылки без userinfo,
+# IPv6 в скобках, порт по умолчанию и т.п.) - полный разбор через parse_proxy_url
+_ENDPOINT_MATCH = re.compile(
+    r"^(?:vless|vmess|trojan|hysteria|hysteria2|hy2)://[^@/]+@([^:/?#@\[\]]+):(\d+)(?=[/?#]|$)"
+).match
+
+# Строки-кандидаты в блоке: первый непробельный символ - не '#' (комментарии и пустые строки пропускаются)
+_CANDIDATE_LINES = re.compile(r"^[^\S\n]*[^\s#][^\n]*\n?", re.MULTILINE).finditer
+
+# Сколько строк копить перед выводом в stdout
+_WRITE_BATCH_LINES = 1024
+
+
+@lru_cache(maxsize=65536)
 def _normalize_host(h: str) -> str:
-    """Домены сравниваем без учёта регистра, IP - как есть."""
+    """Домены сравниваем без учёта регистра, IP - как есть. Результат кэшируется: хосты сильно повторяются."""
     s = (h or "").strip()
     if not s:
         return s
     # Числовой IP оставляем как есть; иначе приводим к нижнему регистру
-    if s.replace(".", "").replace(":", "").isdigit() or (
-        ":" in s and s.split(":")[0].replace(".", "").isdigit()
+    if _IS_NUMERIC(s) is not None or (
+        ":" in s and s.partition(":")[0].translate(_STRIP_DOTS).isdigit()
     ):
         return s
     return s.lower()
 
 
-def _parse_exclude_lines(lines: list[str]) -> tuple[set[str], set[str]]:
+def _parse_exclude_lines(lines: Iterable[str]) -> tuple[set[str], set[str]]:
     """
-    Парсит список строк в (exact_endpoints, hosts_only).
+    Парсит строки (список или открытый файл) в (exact_endpoints, hosts_only).
     exact_endpoints: множество "host:port". hosts_only: множество "host" (любой порт).
     """
     exact_endpoints: set[str] = set()
@@ -65,10 +91,14 @@ def _parse_exclude_lines(lines: list[str]) -> tuple[set[str], set[str]]:
 
 def load_exclude_set_from_file(filepath: str) -> tuple[set[str], set[str]]:
     """Читает файл исключений. Возвращает (exact_endpoints, hosts_only)."""
-    if not filepath or not os.path.isfile(filepath):
+    if not filepath:
+        return set(), set()
+    # Без отдельного os.path.isfile: отсутствующий или нечитаемый файл (каталог, нет прав) - по исключению от open
+    try:
+        with open(filepath, encoding="utf-8") as f:
+            return _parse_exclude_lines(f)
+    except OSError:
         return set(), set()
-    with open(filepath, encoding="utf-8") as f:
-        return _parse_exclude_lines(f.readlines())
 
 
 def is_excluded(
@@ -89,6 +119,27 @@ def is_excluded(
     return None
 
 
+def _build_rules(exact_endpoints: set[str], hosts_only: set[str]) -> dict[str, dict[int | None, str]]:
+    """
+    Объединяет правила в один словарь host -> {port: "host:port", None: "host"}.
+    Ключ None - исключение хоста на любом порту; точное правило по порту имеет приоритет.
+    """
+    rules: dict[str, dict[int | None, str]] = {}
+    for rule in exact_endpoints:
+        host, _, port = rule.rpartition(":")
+        rules.setdefault(host, {})[int(port)] = rule
+    for host in hosts_only:
+        rules.setdefault(host, {})[None] = host
+    return rules
+
+
+def _open_input():
+    """Входной поток: файл из аргумента (буфер 1 МБ) или stdin."""
+    if sys.argv[1:]:
+        return open(sys.argv[1], encoding="utf-8", buffering=1 << 20)
+    return contextlib.nullcontext(sys.stdin)
+
+
 def main() -> None:
     # Приоритет: переменная EXCLUDE_ENDPOINTS (построчно), иначе файл EXCLUDE_ENDPOINTS_FILE
     var_content = (os.environ.get("EXCLUDE_ENDPOINTS") or "").strip()
@@ -99,53 +150,63 @@ def main() -> None:
         filepath = os.environ.get("EXCLUDE_ENDPOINTS_FILE", "configs/exclude_endpoints").strip()
         exact_endpoints, hosts_only = load_exclude_set_from_file(filepath)
         filter_source = f"файл {filepath}" if filepath else "не задан"
-    if not exact_endpoints and not hosts_only:
-        # Нет списка или файл пуст - пропускаем все строки без фильтрации
-        if sys.argv[1:]:
-            with open(sys.argv[1], encoding="utf-8") as f:
-                for line in f:
-                    sys.stdout.write(line)
-        else:
-            for line in sys.stdin:
-                sys.stdout.write(line)
-        return
-
-    if sys.argv[1:]:
-        with open(sys.argv[1], encoding="utf-8") as f:
-            lines = f.readlines()
-    else:
-        lines = sys.stdin.readlines()
-
-    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
-    from lib.parsing import parse_proxy_url
-
     source_name = sys.argv[1] if sys.argv[1:] else "stdin"
     excluded_count = 0
     by_rule: dict[str, int] = {}
 
-    for line in lines:
-        s = line.rstrip("\n\r")
-        if not s.strip() or s.strip().startswith("#"):
-            sys.stdout.write(line)
-            continue
-        link = s.split(maxsplit=1)[0].strip()
-        if "#" in link:
-            link = link.split("#", 1)[0].strip()
-        parsed = parse_proxy_url(link)
-        if not parsed:
-            sys.stdout.write(line)
-            continue
-        address = parsed.get("address") or ""
-        try:
-            port = int(parsed.get("port", 0) or 0)
-        except (TypeError, ValueError):
-            port = 0
-        matched_rule = is_excluded(address, port, exact_endpoints, hosts_only)
-        if matched_rule is not None:
-            excluded_count += 1
-            by_rule[matched_rule] = by_rule.get(matched_rule, 0) + 1
-            continue
-        sys.stdout.write(line)
+    # Вход читается потоково (без readlines), строки выводятся по мере обработки
+    with _open_input() as f:
+        if not exact_endpoints and not hosts_only:
+            # Нет списка или файл пуст - копируем вход в выход блоками, без разбора по строкам
+            shutil.copyfileobj(f, sys.stdout, length=1 << 20)
+            return
+
+        # Проходящие строки копим и выводим пачками через writelines
+        out_buf: list[str] = []
+        write = out_buf.append
+        rules = _build_rules(exact_endpoints, hosts_only)
+        for data in read_blocks(f):
+            # Регулярка находит только строки-кандидаты; пустые строки и комментарии между ними
+            # переносятся в выход одним срезом
+            last = 0
+            for cand in _CANDIDATE_LINES(data):
+                if len(out_buf) >= _WRITE_BATCH_LINES:
+                    sys.stdout.writelines(out_buf)
+                    out_buf.clear()
+                start, end = cand.span()
+                if start > last:
+                    write(data[last:start])
+                last = end
+                line = cand.group()
+                link = line.split(None, 1)[0]
+                if "#" in link:
+                    link = link.split("#", 1)[0].strip()
+                m = _ENDPOINT_MATCH(link)
+                if m is not None:
+                    # Быстрый путь: host:port прямо из URI, без полного разбора ссылки
+                    host_norm = _normalize_host(m.group(1))
+                    port = int(m.group(2))
+                else:
+                    parsed = parse_proxy_url(link)
+                    if not parsed:
+                        write(line)
+                        continue
+                    host_norm = _normalize_host(parsed.get("address") or "")
+                    try:
+                        port = int(parsed.get("port", 0) or 0)
+                    except (TypeError, ValueError):
+                        port = 0
+                # То же, что is_excluded, но одна хэш-проверка по хосту и без f-строки на каждую строку
+                bucket = rules.get(host_norm)
+                matched_rule = (bucket.get(port) or bucket.get(None)) if bucket else None
+                if matched_rule is not None:
+                    excluded_count += 1
+                    by_rule[matched_rule] = by_rule.get(matched_rule, 0) + 1
+                    continue
+                write(line)
+            if last < len(data):
+                write(data[last:])
+        sys.stdout.writelines(out_buf)
 
     if excluded_count:
         parts = [
@@ -8,20 +8,25 @@
 Запуск: python hysteria_checker.py [файл.txt]  (по умолчанию hys2.txt)
 """
 
+import errno
 import os
 import re
+import selectors
 import shutil
 import socket
 import stat
-import statistics
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+import urllib.error
 import urllib.request
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from pathlib import Path
 
+import requests
 from rich.console import Console
 from rich.panel import Panel
 from rich.progress import (
@@ -83,10 +88,43 @@ if not VERIFY_HTTPS_SSL:
 
 console = Console()
 
-# Путь к бинарнику: HYSTERIA_PATH, или из PATH, или скачиваем для текущей ОС
+def _download_file(url: str, local: Path) -> None:
+    """
+    Потоково скачивает url в local через временный файл <local>.part (переименование по завершении).
+    Оставшийся от прерванной загрузки .part докачивается запросом с заголовком Range.
+    """
+    part = local.with_name(local.name + ".part")
+    offset = part.stat().st_size if part.is_file() else 0
+    req = urllib.request.Request(url, headers={"Range": f"bytes={offset}-"} if offset else {})
+    try:
+        with urllib.request.urlopen(req, timeout=60) as r:
+            if r.status != 206:
+                offset = 0  # сервер отдал файл целиком - пишем заново
+            length = r.headers.get("Content-Length")
+            with open(part, "ab" if offset else "wb") as out:
+                shutil.copyfileobj(r, out, length=1 << 20)
+    except urllib.error.HTTPError as e:
+        if e.code != 416:
+            raise
+        # 416: запрошенный диапазон за концом файла. .part принимаем, только если его размер равен
+        # полному размеру из Content-Range ("bytes */<total>"); иначе он устарел или битый - качаем заново
+        total = (e.headers.get("Content-Range") or "").rpartition("/")[2].strip()
+        if not (total.isdigit() and int(total) == offset):
+            part.unlink()
+            _download_file(url, local)
+            return
+    else:
+        if length is not None and part.stat().st_size != offset + int(length):
+            raise OSError(f"загрузка прервана: получено {part.stat().st_size - offset} из {length} байт")
+    os.replace(part, local)
+
+
+# Путь к бинарнику: HYSTERIA_PATH, или из PATH, или скачиваем для текущей ОС.
+# Результат кэшируется: повторные вызовы не читают окружение и не обращаются к диску
+@lru_cache(maxsize=1)
 def _ensure_hysteria() -> str:
     explicit = os.environ.get("HYSTERIA_PATH", "").strip()
-    if explicit and os.path.isfile(explicit):
+    if explicit and Path(explicit).is_file():
         return explicit
     in_path = shutil.which("hysteria")
     if in_path:
@@ -106,7 +144,7 @@ def _ensure_hysteria() -> str:
     url = f"https://github.com/apernet/hysteria/releases/download/app/v2.4.2/{exe_name}"
     console.print(f"[dim]Скачивание Hysteria: {exe_name}...[/dim]")
     try:
-        urllib.request.urlretrieve(url, local)
+        _download_file(url, local)
         if sys.platform != "win32":
             local.chmod(local.stat().st_mode | stat.S_IXUSR)
     except Exception as e:
@@ -118,10 +156,12 @@ def _ensure_hysteria() -> str:
 HYSTERIA_CMD = _ensure_hysteria()
 HYSTERIA_STARTUP_WAIT = float(os.environ.get("HYSTERIA_STARTUP_WAIT", "5.0"))
 HYSTERIA_PORT_WAIT = float(os.environ.get("HYSTERIA_PORT_WAIT", "20.0"))
-HYSTERIA_STARTUP_POLL = float(os.environ.get("HYSTERIA_STARTUP_POLL_INTERVAL", "0.2"))
 OUTPUT_DIR = os.environ.get("HYSTERIA_OUTPUT_DIR", "configs")
 OUTPUT_FILE = os.environ.get("HYSTERIA_OUTPUT_FILE", "hysteria")
 
+# Состояние рабочего потока (каталог с конфигом клиента)
+_worker_local = threading.local()
+
 
 def print_hysteria_config(input_file: str, output_path: str, total: int) -> None:
     """Выводит текущие параметры проверки в том же стиле, что и vless_checker."""
@@ -163,10 +203,13 @@ def build_hysteria_config(link: str, port: int) -> str:
 def run_hysteria(config_path: str):
     """Запускает hysteria -c config_path. Возвращает subprocess.Popen."""
     try:
+        # На POSIX дескрипторы Python и так не наследуются (PEP 446); без close_fds subprocess
+        # может запускать клиент через posix_spawn вместо fork + закрытия всех fd в потомке
         proc = subprocess.Popen(
             [HYSTERIA_CMD, "-c", config_path],
             stdout=subprocess.DEVNULL,
             stderr=subprocess.PIPE,
+            close_fds=sys.platform == "win32",
             creationflags=subprocess.CREATE_NO_WINDOW if sys.platform == "win32" else 0,
         )
         return proc
@@ -174,16 +217,52 @@ def run_hysteria(config_path: str):
         return None
 
 
-def _wait_for_port(host: str, port: int, max_wait: float, poll_interval: float = 0.1) -> bool:
-    """Ждёт, пока порт станет доступен (SOCKS поднят)."""
+# Коды connect_ex для неблокирующего сокета: соединение ещё устанавливается
+_CONNECT_PENDING = {errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, getattr(errno, "WSAEWOULDBLOCK", 10035)}
+
+
+def _wait_for_port(
+    host: str,
+    port: int,
+    max_wait: float,
+    poll_interval: float = 0.1,
+    proc: subprocess.Popen | None = None,
+) -> bool:
+    """
+    Ждёт, пока порт станет доступен (SOCKS поднят).
+    Неблокирующий connect_ex + ожидание готовности через selectors; после отказа в соединении
+    повтор с экспоненциальной паузой (от 5 мс до poll_interval).
+    Если передан proc - ожидание прерывается (False), как только процесс завершился.
+    """
     deadline = time.perf_counter() + max_wait
-    while time.perf_counter() < deadline:
-        try:
-            with socket.create_connection((host, port), timeout=0.5):
-                return True
-        except (socket.error, socket.gaierror, OSError):
-            time.sleep(poll_interval)
-    return False
+    backoff = 0.005
+    with selectors.DefaultSelector() as sel:
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return False
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                sock.setblocking(False)
+                err = sock.connect_ex((host, port))
+                if err in _CONNECT_PENDING:
+                    sel.register(sock, selectors.EVENT_WRITE)
+                    try:
+                        if not sel.select(timeout=remaining):
+                            return False
+                    finally:
+                        sel.unregister(sock)
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0:
+                    return True
+            except OSError:
+                pass
+            finally:
+                sock.close()
+            if proc is not None and proc.poll() is not None:
+                return False
+            time.sleep(min(backoff, max(0.0, deadline - time.perf_counter())))
+            backoff = min(backoff * 2, poll_interval)
 
 
 def kill_hysteria(proc: subprocess.Popen) -> None:
@@ -200,149 +279,190 @@ def kill_hysteria(proc: subprocess.Popen) -> None:
             pass
 
 
-def check_hysteria_key(link: str) -> tuple[str, bool, dict]:
-    """
-    Проверяет один конфиг Hysteria 2: поднимает локальный прокси, делает запросы.
-    Возвращает (link, ok, metrics).
-    """
-    metrics = {
+def _empty_metrics() -> dict:
+    """Пустые метрики проверки одного ключа."""
+    return {
         "response_times": [],
         "successful_urls": 0,
         "failed_urls": 0,
         "total_requests": 0,
         "successful_requests": 0,
     }
-    parsed = parse_proxy_url(link)
-    if not parsed or parsed.get("protocol") not in ("hysteria", "hysteria2"):
-        return (link, False, metrics)
 
+
+def _worker_config_path() -> str:
+    """
+    Путь к YAML-конфигу клиента для текущего потока. Файл один на поток и перезаписывается
+    при каждой проверке (без mkstemp/unlink на ключ); каталог удаляется вместе с потоком.
+    """
+    path = getattr(_worker_local, "config_path", None)
+    if path is None:
+        _worker_local.tmpdir = tempfile.TemporaryDirectory(prefix="hysteria_")
+        path = _worker_local.config_path = os.path.join(_worker_local.tmpdir.name, "config.yaml")
+    return path
+
+
+def release_hysteria(proc: subprocess.Popen | None, port: int) -> None:
+    """Останавливает клиент и возвращает порт в пул (ровно один раз)."""
+    kill_hysteria(proc)
+    return_port(port)
+
+
+def spawn_hysteria(link: str) -> tuple[subprocess.Popen, int] | None:
+    """
+    Поднимает клиент Hysteria для link на порту из пула и ждёт, пока откроется его SOCKS-порт
+    (не дольше HYSTERIA_STARTUP_WAIT + HYSTERIA_PORT_WAIT).
+    Возвращает (proc, port) или None, если клиент не запустился, завершился или не открыл порт
+    за время ожидания (порт при этом уже возвращён в пул).
+    """
     port = take_port()
     if port is None:
-        return (link, False, metrics)
+        return None
 
-    fd, config_path = tempfile.mkstemp(suffix=".yaml", prefix="hysteria_")
+    config_path = _worker_config_path()
     try:
-        with os.fdopen(fd, "w", encoding="utf-8") as f:
-            f.write(build_hysteria_config(link, port))
-    except Exception:
-        return_port(port)
-        return (link, False, metrics)
+        with open(config_path, "wb") as f:
+            f.write(build_hysteria_config(link, port).encode("utf-8"))
+    except OSError:
+        release_hysteria(None, port)
+        return None
 
     proc = run_hysteria(config_path)
     if proc is None:
-        return_port(port)
-        try:
-            os.unlink(config_path)
-        except FileNotFoundError:
-            pass
-        return (link, False, metrics)
+        release_hysteria(None, port)
+        return None
+
+    # Запуск процесса и открытие порта ждём одним циклом, без фиксированной паузы:
+    # клиент готов, как только принимает соединения; выход процесса - ошибка конфига или сервера
+    max_wait = HYSTERIA_STARTUP_WAIT + HYSTERIA_PORT_WAIT
+    if _wait_for_port("127.0.0.1", port, max_wait=max_wait, proc=proc):
+        return (proc, port)
+    release_hysteria(proc, port)
+    return None
 
+
+def check_hysteria_key(link: str) -> tuple[str, bool, dict]:
+    """
+    Проверяет один конфиг Hysteria 2: поднимает локальный прокси, делает запросы.
+    Возвращает (link, ok, metrics).
+    """
+    parsed = parse_proxy_url(link)
+    if not parsed or parsed.get("protocol") not in ("hysteria", "hysteria2"):
+        return (link, False, _empty_metrics())
+
+    spawned = spawn_hysteria(link)
+    if spawned is None:
+        return (link, False, _empty_metrics())
+    proc, port = spawned
     try:
-        waited = 0.0
-        while waited < HYSTERIA_STARTUP_WAIT:
-            if proc.poll() is not None:
-                return_port(port)
-                return (link, False, metrics)
-            time.sleep(HYSTERIA_STARTUP_POLL)
-            waited += HYSTERIA_STARTUP_POLL
-
-        if not _wait_for_port("127.0.0.1", port, max_wait=HYSTERIA_PORT_WAIT):
-            return_port(port)
-            return (link, False, metrics)
-
-        proxies = {
-            "http": f"socks5h://127.0.0.1:{port}",
-            "https": f"socks5h://127.0.0.1:{port}",
-        }
-        timeout = CONNECT_TIMEOUT
-
-        # Строгий режим: N запросов к gstatic/generate_204, проход при минимум 2 успешных из N (допуск к сетевым сбоям)
-        if STRONG_STYLE_TEST:
-            max_ok_time = STRONG_MAX_RESPONSE_TIME if STRONG_MAX_RESPONSE_TIME > 0 else MAX_RESPONSE_TIME
-            connect_t = max(3, min(10, int(STRONG_STYLE_TIMEOUT * 0.4)))
-            read_t = max(5, STRONG_STYLE_TIMEOUT - connect_t)
-            timeout_strong = (connect_t, read_t)
-            attempts_total = max(2, STRONG_ATTEMPTS)
-            min_success = 2
-            success_count = 0
-            for attempt in range(attempts_total):
-                if attempt > 0:
-                    time.sleep(0.5)
-                response, elapsed_time, error = make_request(
-                    _CLIENT_TEST_HTTPS, proxies, timeout_strong
-                )
-                metrics["total_requests"] = metrics.get("total_requests", 0) + 1
-                if response and not error and check_response_valid(response, 0, _CLIENT_TEST_HTTPS):
-                    if max_ok_time > 0 and elapsed_time > max_ok_time:
-                        continue
-                    metrics["response_times"].append(elapsed_time)
-                    success_count += 1
-            if success_count >= min_success:
-                metrics["successful_requests"] = success_count
-                metrics["successful_urls"] = 1
-                metrics["failed_urls"] = 0
-                return (link, True, metrics)
-            return (link, False, metrics)
-
-        # Много URL + стабильность (как в vless_checker без STRONG_STYLE)
-        all_urls = []
-        if TEST_URLS:
-            all_urls.extend([(url, "http") for url in TEST_URLS])
-        if TEST_URLS_HTTPS:
-            all_urls.extend([(url, "https") for url in TEST_URLS_HTTPS])
-        if not all_urls:
-            all_urls = [(_CLIENT_TEST_HTTPS, "https")]
-
-        stability_results = []
-        for stability_check in range(STABILITY_CHECKS):
-            if stability_check > 0:
-                time.sleep(STABILITY_CHECK_DELAY)
-            successful_urls_count = 0
-            for url, _ in all_urls:
-                request_ok = 0
-                for request_num in range(REQUESTS_PER_URL):
-                    if request_num > 0:
-                        time.sleep(REQUEST_DELAY)
-                    response, elapsed_time, error = make_request(url, proxies, timeout)
-                    metrics["total_requests"] += 1
-                    if response and not error and check_response_valid(response, MIN_RESPONSE_SIZE, url):
-                        if MAX_RESPONSE_TIME > 0 and elapsed_time > MAX_RESPONSE_TIME:
-                            continue
-                        metrics["response_times"].append(elapsed_time)
-                        request_ok += 1
-                        metrics["successful_requests"] += 1
-                if request_ok >= MIN_SUCCESSFUL_REQUESTS:
-                    successful_urls_count += 1
-            passed = (
-                successful_urls_count == len(all_urls)
-                if (STRICT_MODE and STRICT_MODE_REQUIRE_ALL)
-                else successful_urls_count >= MIN_SUCCESSFUL_URLS
-            )
-            if REQUIRE_HTTPS and not any(t == "https" for _, t in all_urls):
-                passed = False
-            stability_results.append(passed)
+        # Одна сессия на проверку: повторные запросы переиспользуют соединение через прокси
+        with requests.Session() as session:
+            ok, metrics = probe_hysteria(port, session)
+        return (link, ok, metrics)
+    finally:
+        release_hysteria(proc, port)
 
-        if STABILITY_CHECKS > 1 and not all(stability_results):
-            return (link, False, metrics)
 
-        metrics["successful_urls"] = successful_urls_count
-        metrics["failed_urls"] = len(all_urls) - successful_urls_count
-        is_available = (
+def probe_hysteria(port: int, session: requests.Session | None = None) -> tuple[bool, dict]:
+    """
+    Проверяет поднятый клиент Hysteria (SOCKS5 на 127.0.0.1:port) запросами через прокси.
+    session - HTTP-сессия для всех запросов проверки (keep-alive). Возвращает (ok, metrics).
+    """
+    metrics = _empty_metrics()
+    proxies = {
+        "http": f"socks5h://127.0.0.1:{port}",
+        "https": f"socks5h://127.0.0.1:{port}",
+    }
+    timeout = CONNECT_TIMEOUT
+
+    # Строгий режим: N запросов к gstatic/generate_204, проход при минимум 2 успешных из N (допуск к сетевым сбоям)
+    if STRONG_STYLE_TEST:
+        max_ok_time = STRONG_MAX_RESPONSE_TIME if STRONG_MAX_RESPONSE_TIME > 0 else MAX_RESPONSE_TIME
+        connect_t = max(3, min(10, int(STRONG_STYLE_TIMEOUT * 0.4)))
+        read_t = max(5, STRONG_STYLE_TIMEOUT - connect_t)
+        timeout_strong = (connect_t, read_t)
+        attempts_total = max(2, STRONG_ATTEMPTS)
+        min_success = 2
+        success_count = 0
+        for attempt in range(attempts_total):
+            if attempt > 0:
+                time.sleep(0.5)
+            response, elapsed_time, error = make_request(
+                _CLIENT_TEST_HTTPS, proxies, timeout_strong, session=session
+            )
+            metrics["total_requests"] = metrics.get("total_requests", 0) + 1
+            ok = response and not error and check_response_valid(response, 0, _CLIENT_TEST_HTTPS)
+            # Слишком медленный ответ не засчитывается, но проверка досрочного итога ниже выполняется всегда
+            if ok and not (max_ok_time > 0 and elapsed_time > max_ok_time):
+                metrics["response_times"].append(elapsed_time)
+                success_count += 1
+            # Итог уже известен: набрали min_success или оставшихся попыток не хватит
+            if success_count >= min_success or success_count + (attempts_total - attempt - 1) < min_success:
+                break
+        if success_count >= min_success:
+            metrics["successful_requests"] = success_count
+            metrics["successful_urls"] = 1
+            metrics["failed_urls"] = 0
+            return (True, metrics)
+        return (False, metrics)
+
+    # Много URL + стабильность (как в vless_checker без STRONG_STYLE)
+    all_urls = []
+    if TEST_URLS:
+        all_urls.extend([(url, "http") for url in TEST_URLS])
+    if TEST_URLS_HTTPS:
+        all_urls.extend([(url, "https") for url in TEST_URLS_HTTPS])
+    if not all_urls:
+        all_urls = [(_CLIENT_TEST_HTTPS, "https")]
+
+    require_all = STRICT_MODE and STRICT_MODE_REQUIRE_ALL
+    stability_results = []
+    for stability_check in range(STABILITY_CHECKS):
+        if stability_check > 0:
+            time.sleep(STABILITY_CHECK_DELAY)
+        successful_urls_count = 0
+        for url, _ in all_urls:
+            request_ok = 0
+            for request_num in range(REQUESTS_PER_URL):
+                if request_num > 0:
+                    time.sleep(REQUEST_DELAY)
+                response, elapsed_time, error = make_request(url, proxies, timeout, session=session)
+                metrics["total_requests"] += 1
+                if response and not error and check_response_valid(response, MIN_RESPONSE_SIZE, url):
+                    if MAX_RESPONSE_TIME > 0 and elapsed_time > MAX_RESPONSE_TIME:
+                        continue
+                    metrics["response_times"].append(elapsed_time)
+                    request_ok += 1
+                    metrics["successful_requests"] += 1
+            if request_ok >= MIN_SUCCESSFUL_REQUESTS:
+                successful_urls_count += 1
+            elif require_all:
+                # Нужны все URL, один уже не прошёл - остальные не проверяем
+                break
+        passed = (
             successful_urls_count == len(all_urls)
-            if (STRICT_MODE and STRICT_MODE_REQUIRE_ALL)
+            if require_all
             else successful_urls_count >= MIN_SUCCESSFUL_URLS
         )
-        if REQUIRE_HTTPS and not all_urls:
-            is_available = False
-        return (link, is_available, metrics)
-
-    finally:
-        kill_hysteria(proc)
-        try:
-            os.unlink(config_path)
-        except FileNotFoundError:
-            pass
-        return_port(port)
+        if REQUIRE_HTTPS and not any(t == "https" for _, t in all_urls):
+            passed = False
+        stability_results.append(passed)
+        if not passed and STABILITY_CHECKS > 1:
+            break
+
+    if STABILITY_CHECKS > 1 and not all(stability_results):
+        return (False, metrics)
+
+    metrics["successful_urls"] = successful_urls_count
+    metrics["failed_urls"] = len(all_urls) - successful_urls_count
+    is_available = (
+        successful_urls_count == len(all_urls)
+        if require_all
+        else successful_urls_count >= MIN_SUCCESSFUL_URLS
+    )
+    if REQUIRE_HTTPS and not all_urls:
+        is_available = False
+    return (is_available, metrics)
 
 
 def main():
@@ -361,11 +481,17 @@ def main():
         console.print("[yellow]Нет конфигов Hysteria в файле.[/yellow]")
         sys.exit(0)
 
-    # Дедупликация по нормализованному ключу
+    # Дедупликация по нормализованному ключу. Дубликаты обычно отличаются только #фрагментом,
+    # поэтому сначала отсекаем уже встреченные префиксы до '#' и нормализуем только новые
+    seen_prefixes = set()
     seen = set()
     unique = []
     for link, full in keys:
-        norm = normalize_proxy_link(link)
+        prefix = link.partition("#")[0]
+        if prefix in seen_prefixes:
+            continue
+        seen_prefixes.add(prefix)
+        norm = normalize_proxy_link(prefix)
         if norm and norm not in seen:
             seen.add(norm)
             unique.append((link, full))
@@ -429,11 +555,12 @@ def main():
     # Результаты для метрик (как в vless_checker)
     results_for_metrics = []
     for link, metrics in all_metrics.items():
+        rt = metrics.get("response_times", [])
         results_for_metrics.append({
             "key": link,
             "available": link in available_links,
-            "response_times": metrics.get("response_times", []),
-            "avg_response_time": statistics.mean(metrics["response_times"]) if metrics.get("response_times") else 0,
+            "response_times": rt,
+            "avg_response_time": sum(rt) / len(rt) if rt else 0,
             "geolocation": None,
             "error": None,
         })
@@ -4,23 +4,38 @@ Entrypoint для Docker: ограничивает исходящий досту
 CIDR из whitelist (CIDR_WHITELIST_URL). IP прокси в разрешённые не добавляются.
 """
 import ipaddress
+import itertools
 import os
+import shutil
 import subprocess
 import sys
-import urllib.error
 import urllib.parse
-import urllib.request
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
 
-try:
-    from lib.parsing import normalize_proxy_link as _norm_link_entrypoint
-except ImportError:
-    _norm_link_entrypoint = None
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 CIDR_WHITELIST_URL = os.environ.get(
     "CIDR_WHITELIST_URL",
     "https://raw.githubusercontent.com/hxehex/russia-mobile-internet-whitelist/refs/heads/main/cidrwhitelist.txt",
 )
 LINKS_FILE = os.environ.get("LINKS_FILE", "links.txt")
+# Загрузка списков: (connect, read) таймауты и число параллельных загрузок в режиме merge
+FETCH_TIMEOUT = (5, 25)
+FETCH_WORKERS = 16
+# Общая сессия загрузок: keep-alive и пул соединений на хост (повторные запросы к тому же хосту без нового TLS)
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=2, backoff_factor=0.3))
+_SESSION.mount("https://", _ADAPTER)
+_SESSION.mount("http://", _ADAPTER)
+# Управляющие символы, недопустимые в URL (кроме \t, \n, \r)
+_URL_CTRL_CHARS = frozenset(chr(i) for i in range(32) if i not in (9, 10, 13))
+# Схемы ключей, которые принимает parse_vless_lines (VLESS, VMess, Trojan, Shadowsocks)
+_XRAY_SCHEMES = frozenset({"vless", "vmess", "trojan", "ss"})
+# Имя ipset с CIDR whitelist (см. setup_ipset)
+IPSET_NAME = "xraycheck_wl"
 
 
 def fetch(url: str) -> str:
@@ -30,64 +45,83 @@ def fetch(url: str) -> str:
         if not parsed.scheme or not parsed.netloc:
             raise ValueError(f"Некорректный URL: {url}")
         # Проверка на управляющие символы
-        if any(ord(c) < 32 and c not in '\t\n\r' for c in url):
+        if not _URL_CTRL_CHARS.isdisjoint(url):
             raise ValueError(f"URL содержит управляющие символы: {url}")
     except Exception as e:
         raise ValueError(f"Ошибка валидации URL: {e}")
     
-    with urllib.request.urlopen(url, timeout=30) as r:
-        return r.read().decode("utf-8", errors="replace")
+    # Раздельные таймауты: медленное соединение не держит весь таймаут чтения
+    r = _SESSION.get(url, timeout=FETCH_TIMEOUT)
+    r.raise_for_status()
+    return r.content.decode("utf-8", errors="replace")
 
 
 def parse_vless_lines(text: str) -> list[tuple[str, str]]:
     """Строки с прокси-протоколами: (ссылка, полная_строка). Поддерживает VLESS, VMess, Trojan, Shadowsocks."""
-    supported_protocols = ("vless://", "vmess://", "trojan://", "ss://")
     result = []
     for line in text.splitlines():
         line = line.strip()
         if not line:
             continue
-        # Проверяем, начинается ли строка с одного из поддерживаемых протоколов
-        for protocol in supported_protocols:
-            if line.startswith(protocol):
-                link = line.split(maxsplit=1)[0].strip()
-                if link:
-                    result.append((link, line))
-                break
+        # Схема до "://" - одна проверка по множеству вместо сравнения с каждым префиксом
+        scheme, sep, _ = line.partition("://")
+        if sep and scheme in _XRAY_SCHEMES:
+            result.append((line.split(None, 1)[0], line))
     return result
 
 
 def merge_keys_from_urls(urls: list[str]) -> str:
-    """Загружает списки по каждому URL, объединяет ключи (дедупликация по ссылке), возвращает текст."""
+    """Загружает списки по каждому URL (параллельно), объединяет ключи (дедупликация по ссылке), возвращает текст.
+    Результаты обрабатываются в порядке URL, поэтому итог и лог не зависят от порядка завершения загрузок."""
     seen: set[str] = set()
     lines: list[str] = []
     total = len(urls)
     print("\n=== docker (entrypoint): загрузка списка по URL ===")
     print(f"[1] Режим merge: объединение ключей из {total} ссылок (links.txt):")
-    for idx, url in enumerate(urls, 1):
-        try:
-            text = fetch(url)
-            parsed = parse_vless_lines(text)
-            new_count = 0
-            for link, full in parsed:
-                if link not in seen:
-                    seen.add(link)
-                    lines.append(full)
-                    new_count += 1
-            print(f"     [{idx}/{total}] получено {len(parsed)}, новых +{new_count}, всего уникальных: {len(lines)}")
-        except (urllib.error.URLError, urllib.error.HTTPError, OSError, ValueError) as e:
-            error_msg = str(e)
-            if len(error_msg) > 100:
-                error_msg = error_msg[:97] + "..."
-            print(f"     [{idx}/{total}] Ошибка загрузки: {error_msg} (пропущено)", file=sys.stderr)
-            continue
+    with ThreadPoolExecutor(max_workers=max(1, min(FETCH_WORKERS, total))) as executor:
+        futures = [executor.submit(fetch, url) for url in urls]
+        for idx, future in enumerate(futures, 1):
+            try:
+                text = future.result()
+                parsed = parse_vless_lines(text)
+                new_count = 0
+                for link, full in parsed:
+                    if link not in seen:
+                        seen.add(link)
+                        lines.append(full)
+                        new_count += 1
+                print(f"     [{idx}/{total}] получено {len(parsed)}, новых +{new_count}, всего уникальных: {len(lines)}")
+            except (requests.RequestException, OSError, ValueError) as e:
+                error_msg = str(e)
+                if len(error_msg) > 100:
+                    error_msg = error_msg[:97] + "..."
+                print(f"     [{idx}/{total}] Ошибка загрузки: {error_msg} (пропущено)", file=sys.stderr)
+                continue
     print(f"[1] Итого из ссылок: {len(lines)} уникальных ключей (по ссылке)")
     print("=== конец загрузки ===\n")
     return "\n".join(lines)
 
 
-def parse_cidr_whitelist(text: str) -> set[str]:
-    """Парсит список CIDR/IP: по одной записи на строку. Возвращает множество строк 'ip' или 'ip/cidr'."""
+def _norm_link(line: str) -> str:
+    """Ключ дедупликации: первая часть строки (ссылка) без фрагмента #комментарий, как normalize_proxy_link."""
+    parts = line.split(None, 1)
+    return parts[0].partition("#")[0].strip() if parts else ""
+
+
+def dedup_lines(lines: Iterable[str]) -> list[str]:
+    """Дедупликация строк по _norm_link с сохранением порядка (остаётся первое вхождение).
+    lines - любой итерируемый объект (в т.ч. генератор), проход один."""
+    first: dict[str, str] = {}
+    setdefault = first.setdefault
+    for line in lines:
+        key = _norm_link(line)
+        if key:
+            setdefault(key, line)
+    return list(first.values())
+
+
+def parse_cidr_whitelist(text: str) -> set[ipaddress.IPv4Network | ipaddress.IPv6Network]:
+    """Парсит список CIDR/IP: по одной записи на строку. Возвращает множество сетей (одиночный IP - /32 или /128)."""
     result = set()
     for line in text.splitlines():
         line = line.strip()
@@ -96,69 +130,112 @@ def parse_cidr_whitelist(text: str) -> set[str]:
         # Одна запись на строку: 1.2.3.4 или 1.2.3.4/24
         entry = line.split()[0] if line.split() else line
         try:
-            if "/" in entry:
-                ipaddress.ip_network(entry, strict=False)
-                result.add(entry)
-            else:
-                ipaddress.ip_address(entry)
-                result.add(entry)
+            result.add(ipaddress.ip_network(entry, strict=False))
         except ValueError:
             continue
     return result
 
 
+def collapse_networks(nets: Iterable[ipaddress.IPv4Network | ipaddress.IPv6Network]) -> list[str]:
+    """Объединяет пересекающиеся и смежные сети (отдельно IPv4 и IPv6), возвращает CIDR-строки по возрастанию адреса."""
+    v4 = [n for n in nets if n.version == 4]
+    v6 = [n for n in nets if n.version == 6]
+    return [str(n) for group in (v4, v6) for n in ipaddress.collapse_addresses(group)]
+
+
 HYSTERIA_PREFIXES = ("hysteria://", "hysteria2://", "hy2://")
+_HYSTERIA_SCHEMES = frozenset(p.partition("://")[0].encode() for p in HYSTERIA_PREFIXES)
 
 
 def split_list_by_protocol(list_path: str) -> tuple[str, str, int, int]:
     """Читает список, разделяет на Xray (VLESS, VMess, Trojan, SS) и Hysteria. Возвращает (path_xray, path_hysteria, n_xray, n_hysteria)."""
     xray_path = "/tmp/xray_list.txt"
     hysteria_path = "/tmp/hysteria_list.txt"
-    xray_lines = []
-    hyst_lines = []
-    with open(list_path, encoding="utf-8") as f:
-        for line in f:
-            s = line.strip()
-            if not s or s.startswith("#"):
-                continue
-            line_endl = line if line.endswith("\n") else line + "\n"
-            if s.startswith(HYSTERIA_PREFIXES):
-                hyst_lines.append(line_endl)
-            else:
-                xray_lines.append(line_endl)
-    with open(xray_path, "w", encoding="utf-8") as f:
-        f.writelines(xray_lines)
-    with open(hysteria_path, "w", encoding="utf-8") as f:
-        f.writelines(hyst_lines)
+    xray_lines: list[bytes] = []
+    hyst_lines: list[bytes] = []
+    # Файл целиком в байтах: разбор и классификация без декодирования; схема - один поиск по множеству
+    with open(list_path, "rb") as f:
+        data = f.read()
+    for line in data.splitlines():
+        s = line.strip()
+        if not s or s[:1] == b"#":
+            continue
+        scheme, sep, _ = s.partition(b"://")
+        if sep and scheme in _HYSTERIA_SCHEMES:
+            hyst_lines.append(line)
+        else:
+            xray_lines.append(line)
+    # Перевод строки в выходных файлах - \n (окончания \r\n и \r нормализуются)
+    for path, lines in ((xray_path, xray_lines), (hysteria_path, hyst_lines)):
+        with open(path, "wb") as f:
+            if lines:
+                f.write(b"\n".join(lines) + b"\n")
     return xray_path, hysteria_path, len(xray_lines), len(hyst_lines)
 
 
-def setup_iptables(allowed_destinations: set[str]) -> None:
-    """Разрешить только исходящие соединения к allowed_destinations (IP или CIDR), localhost и DNS.
-    Использует iptables-restore для быстрой загрузки десятков тысяч правил одним вызовом."""
-    lines = [
-        "*filter",
-        ":OUTPUT ACCEPT [0:0]",
-        "-F OUTPUT",
-        "-P OUTPUT DROP",
-        "-A OUTPUT -o lo -j ACCEPT",
-        "-A OUTPUT -m state --state ESTABLISHED,RELATED -j ACCEPT",
-    ]
-    for dns_ip in ("8.8.8.8", "8.8.4.4", "1.1.1.1"):
-        lines.append(f"-A OUTPUT -p udp --dport 53 -d {dns_ip} -j ACCEPT")
-    for dest in sorted(allowed_destinations):
-        if dest:
-            lines.append(f"-A OUTPUT -d {dest} -j ACCEPT")
-    lines.append("COMMIT")
-    script = "\n".join(lines) + "\n"
-    proc = subprocess.run(
-        ["iptables-restore", "--noflush"],
-        input=script.encode(),
-        capture_output=True,
-        timeout=60,
-    )
+def _restore(cmd: list[str], lines: Iterable[str]) -> None:
+    """Передаёт скрипт построчно в stdin cmd (ipset/iptables-restore), не собирая его в одну строку.
+    Ненулевой код возврата - RuntimeError с выводом stderr."""
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        write = proc.stdin.write
+        for line in lines:
+            write(f"{line}\n".encode())
+    except BrokenPipeError:
+        # Процесс завершился раньше (ошибка в скрипте) - причина будет в stderr
+        pass
+    try:
+        _, err = proc.communicate(timeout=60)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        raise
     if proc.returncode != 0:
-        raise RuntimeError(f"iptables-restore failed: {proc.stderr.decode(errors='replace')}")
+        raise RuntimeError(f"{' '.join(cmd)} failed: {err.decode(errors='replace').strip()}")
+
+
+def setup_ipset(allowed_destinations: Iterable[str]) -> bool:
+    """Загружает allowed_destinations (IPv4 IP/CIDR) в ipset IPSET_NAME (hash:net) одним вызовом ipset restore.
+    Возвращает False, если утилита ipset недоступна (тогда правила iptables создаются по одному на запись)."""
+    if shutil.which("ipset") is None:
+        return False
+    # hash:net family inet - только IPv4; IPv6 iptables (v4) всё равно не сопоставляет
+    dests = [d for d in allowed_destinations if d and ":" not in d]
+    header = (
+        f"create {IPSET_NAME} hash:net family inet hashsize 16384 maxelem {max(200000, len(dests))}",
+        f"flush {IPSET_NAME}",
+    )
+    _restore(["ipset", "restore", "-!"], itertools.chain(header, (f"add {IPSET_NAME} {dest}" for dest in dests)))
+    return True
+
+
+def _iptables_lines(allowed_destinations: Iterable[str], ipset_name: str | None) -> Iterator[str]:
+    """Строки скрипта iptables-restore для setup_iptables."""
+    yield "*filter"
+    yield ":OUTPUT ACCEPT [0:0]"
+    yield "-F OUTPUT"
+    yield "-P OUTPUT DROP"
+    yield "-A OUTPUT -o lo -j ACCEPT"
+    yield "-A OUTPUT -m state --state ESTABLISHED,RELATED -j ACCEPT"
+    for dns_ip in ("8.8.8.8", "8.8.4.4", "1.1.1.1"):
+        yield f"-A OUTPUT -p udp --dport 53 -d {dns_ip} -j ACCEPT"
+    if ipset_name:
+        yield f"-A OUTPUT -m set --match-set {ipset_name} dst -j ACCEPT"
+    else:
+        # Порядок правил на сопоставление не влияет (список из collapse_networks и так упорядочен по адресу);
+        # строковая сортировка - только по запросу REPRODUCIBLE_IPTABLES
+        dests = sorted(allowed_destinations) if os.environ.get("REPRODUCIBLE_IPTABLES") else allowed_destinations
+        for dest in dests:
+            if dest:
+                yield f"-A OUTPUT -d {dest} -j ACCEPT"
+    yield "COMMIT"
+
+
+def setup_iptables(allowed_destinations: Iterable[str], ipset_name: str | None = None) -> None:
+    """Разрешить только исходящие соединения к allowed_destinations (IP или CIDR), localhost и DNS.
+    Если задан ipset_name (см. setup_ipset), whitelist проверяется одним правилом -m set (поиск по хэшу),
+    иначе - по правилу на запись через iptables-restore одним вызовом (скрипт передаётся потоково)."""
+    _restore(["iptables-restore", "--noflush"], _iptables_lines(allowed_destinations, ipset_name))
 
 
 def main():
@@ -258,21 +335,7 @@ def main():
         print(f"[1] Входной список (stdin): {len(raw_lines)} записей (без дедупликации - передано с хоста)")
         print(f"[2] К передаче в проверку: {len(lines_dedup)} записей")
     else:
-        def _norm_link(line: str) -> str:
-            if _norm_link_entrypoint is not None:
-                return _norm_link_entrypoint(line)
-            s = line.strip().split(maxsplit=1)[0].strip()
-            if "#" in s:
-                s = s.split("#", 1)[0].strip()
-            return s
-
-        seen_norm = set()
-        lines_dedup = []
-        for line in raw_lines:
-            n = _norm_link(line)
-            if n and n not in seen_norm:
-                seen_norm.add(n)
-                lines_dedup.append(line)
+        lines_dedup = dedup_lines(raw_lines)
         with open(list_file, "w", encoding="utf-8") as f:
             f.write("\n".join(lines_dedup) + ("\n" if lines_dedup else ""))
 
@@ -293,12 +356,32 @@ def main():
     cidr_entries = parse_cidr_whitelist(cidr_text)
     print(f"Записей CIDR в белом списке: {len(cidr_entries)}")
 
-    allowed_destinations = cidr_entries
+    # Пересекающиеся и смежные сети объединяем: меньше записей в ipset/iptables
+    allowed_destinations = collapse_networks(cidr_entries)
     print(f"Разрешённых назначений (только CIDR whitelist): {len(allowed_destinations)}")
 
     print("Применение iptables (только CIDR whitelist)...")
     try:
-        setup_iptables(allowed_destinations)
+        # Без ipset (нет утилиты, модулей ядра ip_set/xt_set и т.п.) - whitelist правилами iptables по одному на запись
+        try:
+            use_ipset = setup_ipset(allowed_destinations)
+            if not use_ipset:
+                print("ipset не найден: whitelist загружается правилами iptables по одному на запись")
+        except (RuntimeError, OSError) as e:
+            print(f"ipset недоступен ({e}): whitelist загружается правилами iptables по одному на запись", file=sys.stderr)
+            use_ipset = False
+        if use_ipset:
+            try:
+                setup_iptables(allowed_destinations, ipset_name=IPSET_NAME)
+            except RuntimeError as e:
+                # iptables-restore применяет скрипт атомарно: после ошибки правила не изменены, можно повторить
+                print(
+                    f"Правило -m set отклонено ({e}): whitelist загружается правилами iptables по одному на запись",
+                    file=sys.stderr,
+                )
+                use_ipset = False
+        if not use_ipset:
+            setup_iptables(allowed_destinations, ipset_name=None)
     except Exception as e:
         print(f"Ошибка iptables (нужен cap NET_ADMIN): {e}", file=sys.stderr)
         sys.exit(1)
@@ -389,23 +472,19 @@ def main():
 
     # 5) Слияние Xray + Hysteria в white-list_available и top100; дедупликация по нормализованной ссылке (без #)
     merged = (xray_content.rstrip() + "\n" + hysteria_content).strip() if hysteria_content else xray_content.strip()
-    raw_lines = [l for l in merged.splitlines() if l.strip()]
-
-    def _norm_link(line: str) -> str:
-        s = line.strip().split(maxsplit=1)[0].strip()
-        if "#" in s:
-            s = s.split("#", 1)[0].strip()
-        return s
-
-    seen_norm = set()
-    lines = []
-    for line in raw_lines:
-        n = _norm_link(line)
-        if n and n not in seen_norm:
-            seen_norm.add(n)
-            lines.append(line)
-    if len(lines) != len(raw_lines):
-        print(f"Дедупликация: {len(raw_lines)} → {len(lines)} уникальных прокси")
+    # Непустые строки идут в дедупликацию генератором (без списка raw_lines) и считаются в том же проходе
+    n_raw = 0
+
+    def non_empty(src: Iterable[str]) -> Iterator[str]:
+        nonlocal n_raw
+        for l in src:
+            if l.strip():
+                n_raw += 1
+                yield l
+
+    lines = dedup_lines(non_empty(merged.splitlines()))
+    if len(lines) != n_raw:
+        print(f"Дедупликация: {n_raw} → {len(lines)} уникальных прокси")
 
     merged_dedup = "\n".join(lines) + ("\n" if lines else "")
     with open(wl_path, "w", encoding="utf-8") as f:
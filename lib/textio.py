@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Модуль потокового чтения текстовых файлов (без внешних зависимостей).
+"""
+
+from collections.abc import Iterator
+
+
+def read_blocks(f, size: int = 1 << 20) -> Iterator[str]:
+    """Читает текстовый поток блоками примерно по size символов; каждый блок заканчивается на границе строки."""
+    tail = ""
+    while True:
+        chunk = f.read(size)
+        if not chunk:
+            if tail:
+                yield tail
+            return
+        chunk = tail + chunk
+        cut = chunk.rfind("\n") + 1
+        if cut == 0:
+            tail = chunk
+            continue
+        tail = chunk[cut:]
+        yield chunk[:cut]
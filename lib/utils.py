@@ -61,19 +61,22 @@ def make_request(
     timeout: float | tuple[float, float],
     method: str = "GET",
     post_data: Optional[dict] = None,
+    session: Optional[requests.Session] = None,
 ) -> tuple[Optional[requests.Response], float, Optional[Exception]]:
     """Выполняет HTTP-запрос и возвращает (response, время_ответа, ошибка).
-    timeout: число (общий таймаут) или (connect_timeout, read_timeout)."""
+    timeout: число (общий таймаут) или (connect_timeout, read_timeout).
+    session: если задана, запрос идёт через неё (keep-alive между повторными запросами)."""
     start_time = time.perf_counter()
     verify_ssl = VERIFY_HTTPS_SSL if url.lower().startswith("https://") else True
+    client = session if session is not None else requests
     try:
         if method == "POST" and post_data:
-            r = requests.post(
+            r = client.post(
                 url, proxies=proxies, timeout=timeout, json=post_data,
                 allow_redirects=False, verify=verify_ssl,
             )
         else:
-            r = requests.get(
+            r = client.get(
                 url, proxies=proxies, timeout=timeout,
                 allow_redirects=False, verify=verify_ssl,
             )
@@ -9,11 +9,11 @@ Speedtest для конфигов Hysteria 2 (hy2://, hysteria2://).
 
 import os
 import re
-import socket
 import sys
-import tempfile
+import threading
 import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache, partial
 from pathlib import Path
 
 from dotenv import load_dotenv
@@ -27,8 +27,9 @@ from rich.table import Table
 # Импорт из hysteria_checker (поднимает HYSTERIA_CMD и т.д.)
 from hysteria_checker import (
     HYSTERIA_PORT_WAIT,
-    HYSTERIA_STARTUP_POLL,
     HYSTERIA_STARTUP_WAIT,
+    _wait_for_port,
+    _worker_config_path,
     build_hysteria_config,
     kill_hysteria,
     run_hysteria,
@@ -55,45 +56,101 @@ import requests
 
 console = Console()
 
-_LATENCY_PREFIX_RE = re.compile(r"^\[\d+ms\]\s*", re.MULTILINE)
+# Функция получает одну строку - MULTILINE не нужен; ASCII: \d без юникодных таблиц
+_LATENCY_PREFIX_RE = re.compile(r"^\[\d+ms\]\s*", re.ASCII)
+# Размер куска при замере скорости загрузки
+_DOWNLOAD_CHUNK = 65536
 _HY2_PREFIXES = ("hy2://", "hysteria2://", "hysteria://")
 
 
 def _strip_latency_prefix(line: str) -> str:
-    return _LATENCY_PREFIX_RE.sub("", line).strip()
+    # Большинство строк без префикса - регулярку запускаем только если строка начинается с "["
+    if line[:1] != "[":
+        return line.strip()
+    return _LATENCY_PREFIX_RE.sub("", line, count=1).strip()
 
 
-def _wait_for_port(host: str, port: int, max_wait: float, poll_interval: float = 0.05) -> bool:
-    deadline = time.perf_counter() + max_wait
-    while time.perf_counter() < deadline:
+@lru_cache(maxsize=8192)
+def _proxy_protocol(line: str) -> str | None:
+    """Протокол ключа по parse_proxy_url; кэшируется по строке (повторные прогоны того же списка не парсят заново).
+    Кэшируется строка, а не словарь разбора - общий изменяемый dict между потоками не отдаём."""
+    parsed = parse_proxy_url(line)
+    return parsed.get("protocol") if parsed else None
+
+
+# Остановка клиентов в фоне: SIGTERM отправляется сразу, ожидание выхода (и kill) - в пуле очистки из main,
+# так что слот пула проверок освобождается, не дожидаясь hysteria. Порт возвращается только после выхода процесса
+_cleanup_cond = threading.Condition()
+_cleanup_pending = 0
+
+
+def _teardown(proc, port: int) -> None:
+    """Дожидается выхода клиента (kill по таймауту) и последним шагом возвращает порт в пул."""
+    global _cleanup_pending
+    try:
+        kill_hysteria(proc)
+    finally:
+        return_port(port)
+        with _cleanup_cond:
+            _cleanup_pending -= 1
+            _cleanup_cond.notify_all()
+
+
+def _release(proc, port: int, cleanup: ThreadPoolExecutor | None) -> None:
+    """Останавливает клиент и возвращает порт: через пул cleanup, а без него - синхронно."""
+    global _cleanup_pending
+    if cleanup is None:
         try:
-            with socket.create_connection((host, port), timeout=0.3):
-                return True
-        except (socket.error, socket.gaierror, OSError):
-            time.sleep(poll_interval)
-    return False
+            kill_hysteria(proc)
+        finally:
+            return_port(port)
+        return
+    try:
+        proc.terminate()
+    except OSError:
+        pass
+    with _cleanup_cond:
+        _cleanup_pending += 1
+    try:
+        cleanup.submit(_teardown, proc, port)
+    except RuntimeError:
+        # Пул уже остановлен - завершаем здесь
+        _teardown(proc, port)
+
 
+def _take_port() -> int | None:
+    """take_port; если пул пуст, но порты ещё в фоновой очистке - ждёт их возврата."""
+    with _cleanup_cond:
+        while True:
+            port = take_port()
+            if port is not None or _cleanup_pending == 0:
+                return port
+            _cleanup_cond.wait()
 
-def _test_download_speed(proxies: dict, url: str, timeout_sec: int) -> float | None:
+
+def _test_download_speed(
+    proxies: dict, url: str, timeout_sec: int, session: requests.Session
+) -> float | None:
     try:
         verify = VERIFY_HTTPS_SSL if url.lower().startswith("https://") else True
         start_time = time.perf_counter()
-        r = requests.get(
+        with session.get(
             url,
             proxies=proxies,
             timeout=(5, timeout_sec),
             stream=True,
             allow_redirects=False,
             verify=verify,
-        )
-        if r.status_code != 200:
-            return None
-        downloaded = 0
-        for chunk in r.iter_content(chunk_size=8192):
-            if chunk:
+        ) as r:
+            if r.status_code != 200:
+                return None
+            downloaded = 0
+            # Читаем сырой поток urllib3 крупными кусками без декодирования: меньше итераций на Python,
+            # и считаются байты, реально прошедшие через прокси
+            for chunk in r.raw.stream(_DOWNLOAD_CHUNK, decode_content=False):
                 downloaded += len(chunk)
-            if time.perf_counter() - start_time > timeout_sec:
-                break
+                if time.perf_counter() - start_time > timeout_sec:
+                    break
         elapsed = time.perf_counter() - start_time
         if elapsed < 0.3:
             return None
@@ -112,50 +169,39 @@ def speed_test_hysteria_key(
     download_timeout: int = 30,
     download_url_small: str = "",
     download_url_medium: str = "",
+    cleanup: ThreadPoolExecutor | None = None,
 ) -> tuple[str, float] | None:
     """
     Speedtest одного Hysteria2-ключа: поднимает клиент, меряет задержку и/или скорость.
     Возвращает (строка_ключа, score): score = latency_ms (меньше лучше) или speed_mbps (больше лучше).
+    cleanup - пул для фоновой остановки клиента (см. _release); без него клиент останавливается синхронно.
     """
-    parsed = parse_proxy_url(proxy_line)
-    if not parsed or parsed.get("protocol") not in ("hysteria", "hysteria2"):
+    if _proxy_protocol(proxy_line) not in ("hysteria", "hysteria2"):
         return None
 
-    port = take_port()
+    port = _take_port()
     if port is None:
         return None
 
-    fd, config_path = tempfile.mkstemp(suffix=".yaml", prefix="hy_st_")
+    # Конфиг пишется в файл потока из hysteria_checker (перезапись, без mkstemp/unlink на ключ)
+    config_path = _worker_config_path()
     try:
-        with os.fdopen(fd, "w", encoding="utf-8") as f:
-            f.write(build_hysteria_config(proxy_line, port))
-    except Exception:
-        try:
-            os.close(fd)
-        except OSError:
-            pass
+        with open(config_path, "wb") as f:
+            f.write(build_hysteria_config(proxy_line, port).encode("utf-8"))
+    except OSError:
         return_port(port)
         return None
 
     proc = run_hysteria(config_path)
     if proc is None:
         return_port(port)
-        try:
-            os.unlink(config_path)
-        except FileNotFoundError:
-            pass
         return None
 
     try:
-        waited = 0.0
-        while waited < HYSTERIA_STARTUP_WAIT:
-            if proc.poll() is not None:
-                return_port(port)
-                return None
-            time.sleep(HYSTERIA_STARTUP_POLL)
-            waited += HYSTERIA_STARTUP_POLL
-
-        if not _wait_for_port("127.0.0.1", port, max_wait=min(HYSTERIA_PORT_WAIT, timeout + 5)):
+        # Ожидание старта и порта одним циклом: неблокирующий connect с нарастающей паузой (5-50 мс),
+        # выход сразу при готовности SOCKS или при завершении процесса (порт вернёт finally)
+        max_wait = HYSTERIA_STARTUP_WAIT + min(HYSTERIA_PORT_WAIT, timeout + 5)
+        if not _wait_for_port("127.0.0.1", port, max_wait=max_wait, poll_interval=0.05, proc=proc):
             return None
 
         proxies = {
@@ -168,41 +214,46 @@ def speed_test_hysteria_key(
         connect_t = min(5, max(1.0, per_request_timeout * 0.5))
         read_t = min(15, max(3.0, per_request_timeout * 0.6))
 
-        for _ in range(requests_count):
-            if time.perf_counter() >= deadline:
-                break
-            resp, elapsed, err = make_request(test_url, proxies, (connect_t, read_t))
-            if resp and not err and check_response_valid(resp, 0, test_url):
-                response_times.append(elapsed * 1000.0)
+        # Одна сессия на ключ: запросы к одному прокси переиспользуют соединение, пул закрывается вместе с клиентом
+        with requests.Session() as session:
+            for _ in range(requests_count):
+                if time.perf_counter() >= deadline:
+                    break
+                resp, elapsed, err = make_request(test_url, proxies, (connect_t, read_t), session=session)
+                if resp and not err and check_response_valid(resp, 0, test_url):
+                    response_times.append(elapsed * 1000.0)
 
-        if not response_times:
-            return None
+            if not response_times:
+                return None
 
-        avg_latency_ms = sum(response_times) / len(response_times)
+            avg_latency_ms = sum(response_times) / len(response_times)
 
-        if mode == "quick" and download_url_small:
-            speed_mbps = _test_download_speed(proxies, download_url_small, min(10, download_timeout))
-            if speed_mbps is not None:
-                return (proxy_line, speed_mbps)
-            return None
-        if mode == "full" and download_url_medium:
-            speed_mbps = _test_download_speed(proxies, download_url_medium, download_timeout)
-            if speed_mbps is not None:
-                return (proxy_line, speed_mbps)
-            return None
+            if mode == "quick" and download_url_small:
+                speed_mbps = _test_download_speed(proxies, download_url_small, min(10, download_timeout), session)
+                if speed_mbps is not None:
+                    return (proxy_line, speed_mbps)
+                return None
+            if mode == "full" and download_url_medium:
+                speed_mbps = _test_download_speed(proxies, download_url_medium, download_timeout, session)
+                if speed_mbps is not None:
+                    return (proxy_line, speed_mbps)
+                return None
 
-        if mode == "latency" or not (download_url_small or download_url_medium):
-            if metric == "throughput":
-                return (proxy_line, 100000.0 / avg_latency_ms if avg_latency_ms > 0 else 0)
+            if mode == "latency" or not (download_url_small or download_url_medium):
+                if metric == "throughput":
+                    return (proxy_line, 100000.0 / avg_latency_ms if avg_latency_ms > 0 else 0)
+                return (proxy_line, avg_latency_ms)
             return (proxy_line, avg_latency_ms)
-        return (proxy_line, avg_latency_ms)
     finally:
-        kill_hysteria(proc)
-        try:
-            os.unlink(config_path)
-        except FileNotFoundError:
-            pass
-        return_port(port)
+        _release(proc, port, cleanup)
+
+
+def _safe_result(test_key, line: str) -> tuple[str, float] | None:
+    """Вызов test_key(line); исключение в проверке одного ключа не прерывает спидтест."""
+    try:
+        return test_key(line)
+    except Exception:
+        return None
 
 
 def _load_lines(path: str) -> list[str]:
@@ -211,7 +262,7 @@ def _load_lines(path: str) -> list[str]:
     out = []
     for raw in lines:
         line = _strip_latency_prefix(raw)
-        if line and any(line.startswith(p) for p in _HY2_PREFIXES):
+        if line.startswith(_HY2_PREFIXES):
             out.append(line)
     return out
 
@@ -263,30 +314,37 @@ def main() -> None:
         console=console,
     ) as progress:
         task = progress.add_task("[cyan]Speedtest Hysteria2...[/cyan]", total=len(lines))
-        with ThreadPoolExecutor(max_workers=workers) as executor:
-            futures = {
-                executor.submit(
-                    speed_test_hysteria_key,
-                    line,
-                    SPEED_TEST_TIMEOUT,
-                    SPEED_TEST_METRIC,
-                    SPEED_TEST_REQUESTS,
-                    SPEED_TEST_URL,
-                    mode=SPEED_TEST_MODE,
-                    download_timeout=SPEED_TEST_DOWNLOAD_TIMEOUT,
-                    download_url_small=SPEED_TEST_DOWNLOAD_URL_SMALL,
-                    download_url_medium=SPEED_TEST_DOWNLOAD_URL_MEDIUM,
-                ): line
-                for line in lines
-            }
-            for future in as_completed(futures):
+        test_key = partial(
+            speed_test_hysteria_key,
+            timeout=SPEED_TEST_TIMEOUT,
+            metric=SPEED_TEST_METRIC,
+            requests_count=SPEED_TEST_REQUESTS,
+            test_url=SPEED_TEST_URL,
+            mode=SPEED_TEST_MODE,
+            download_timeout=SPEED_TEST_DOWNLOAD_TIMEOUT,
+            download_url_small=SPEED_TEST_DOWNLOAD_URL_SMALL,
+            download_url_medium=SPEED_TEST_DOWNLOAD_URL_MEDIUM,
+        )
+        # Пул очистки на каждый поток проверок: ожидание выхода клиентов идёт параллельно, как и сами проверки.
+        # Выход из with дожидается остановки всех клиентов hysteria до вывода результатов
+        with (
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hy-clean") as cleanup,
+            ThreadPoolExecutor(max_workers=workers) as executor,
+        ):
+            test_key = partial(test_key, cleanup=cleanup)
+            if SPEED_TEST_MODE == "latency":
+                # Короткие задачи: результаты по порядку через map, без учёта завершений в as_completed
+                pairs = executor.map(partial(_safe_result, test_key), lines)
+            else:
+                # Загрузки долгие - собираем по мере завершения
+                pairs = (
+                    future.result()
+                    for future in as_completed([executor.submit(_safe_result, test_key, line) for line in lines])
+                )
+            for pair in pairs:
                 progress.advance(task)
-                try:
-                    pair = future.result()
-                    if pair is not None:
-                        results.append(pair)
-                except Exception:
-                    pass
+                if pair is not None:
+                    results.append(pair)
 
     elapsed = time.perf_counter() - time_start
     if not results:
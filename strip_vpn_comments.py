@@ -8,12 +8,20 @@ AUTO_COMMENT задаётся переменной окружения (см. .en
 """
 
 import argparse
+import json
 import os
+import re
 import socket
 import sys
 import time
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from string import ascii_uppercase
+from typing import NamedTuple
+
+import urllib3
+
+from lib.textio import read_blocks
 
 # Загружаем .env при локальном запуске
 try:
@@ -28,12 +36,61 @@ try:
 except ImportError:
     parse_proxy_url = None
 
-GEO_API = "http://ip-api.com/json/{ip}?fields=countryCode"
+_READ_BUFFER = 1 << 17  # буфер и размер блока чтения входного файла
+# Поштучный запрос (fetch_countries_single после batch); формат line - только код страны строкой
+GEO_API = "http://ip-api.com/line/{ip}?fields=countryCode"
 GEO_TIMEOUT = 3
 GEO_DELAY = 0.2  # минимальная пауза между запросами (лимит API ~45/мин)
+DNS_WORKERS = 32  # параллельных резолвов хостов
+GEO_BATCH_API = "http://ip-api.com/batch?fields=countryCode,query"
+GEO_BATCH_SIZE = 100  # максимум IP в одном batch-запросе
+GEO_BATCH_DELAY = 4.0  # пауза между batch-запросами (лимит API 15/мин)
+GEO_SINGLE_MAX = 40  # максимум поштучных запросов для IP без ответа batch (лимит API ~45/мин)
+# Кэш IP -> countryCode между запусками (JSON: {"ip": {"cc": "US", "ts": unix_time}})
+GEO_CACHE_PATH = os.environ.get("GEO_CACHE_PATH") or os.path.join(
+    os.path.expanduser("~"), ".cache", "xraycheck", "geo.json"
+)
+GEO_CACHE_TTL = 7 * 24 * 3600  # записи старше - запрашиваются заново
+# Кэш хост -> IP между запусками (JSON: {"host": {"ip": "1.2.3.4", "ts": unix_time}}); DNS меняется чаще страны
+HOST_CACHE_PATH = os.environ.get("HOST_CACHE_PATH") or os.path.join(os.path.dirname(GEO_CACHE_PATH), "hosts.json")
+HOST_CACHE_TTL = 24 * 3600
+
+# Хост -> IP за время процесса (None - не резолвится)
+_host_ip_cache: dict[str, str | None] = {}
+
+# Общий пул соединений к ip-api.com (keep-alive между запросами)
+# Повторы: ошибки соединения и временные ответы (429 - лимит, 5xx) с паузой, в т.ч. по Retry-After.
+# POST к /batch - только чтение, повторять его безопасно
+_HTTP = urllib3.PoolManager(
+    headers={"User-Agent": "XRayCheck/1.0"},
+    retries=urllib3.Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"GET", "POST"}),
+        respect_retry_after_header=True,
+    ),
+)
 
 DEFAULT_AUTO_COMMENT = " verified · XRayCheck"
 
+# Хост после userinfo@ в ссылке известной схемы: [IPv6] или имя/IPv4 до порта, пути или запроса
+_HOST_RE = re.compile(r"^(?:vless|vmess|trojan|ss|hy2|hysteria2?)://[^/?#]*@(\[[^\]]*\]|[^/:?#\[\]]*)")
+
+# Строка-ссылка с комментарием: группа 1 - всё до первого '#'. Строки, начинающиеся с '#', не затрагиваются
+_COMMENT_RE = re.compile(r"^([^\S\n]*[^\s#][^#\n]*)#.*$", re.MULTILINE)
+
+# IP-литералы хоста: IPv4 a.b.c.d; IPv6 - шестнадцатеричные группы через ":" (минимум одно двоеточие)
+_IPV4_RE = re.compile(r"(?:\d{1,3}\.){3}\d{1,3}", re.ASCII)
+_IPV6_RE = re.compile(r"\[?[0-9a-fA-F]*:[0-9a-fA-F:.]*\]?")
+
+# Флаги всех двухбуквенных кодов (AA..ZZ): пара региональных индикаторов, считается один раз при импорте
+CC_TO_FLAG = {
+    a + b: chr(0x1F1E6 + ord(a) - ord("A")) + chr(0x1F1E6 + ord(b) - ord("A"))
+    for a in ascii_uppercase
+    for b in ascii_uppercase
+}
+
 
 def get_auto_comment() -> str:
     """Текст комментария из переменной окружения AUTO_COMMENT."""
@@ -43,17 +100,23 @@ def get_auto_comment() -> str:
 def strip_comment_from_line(line: str) -> str:
     """Убирает из строки фрагмент (комментарий) после первого '#'."""
     line = line.strip()
-    if not line or line.startswith("#"):
+    if not line or line[0] == "#":
         return line
-    return line.split("#", 1)[0].strip()
+    # Начало строки уже без пробелов - после отрезания комментария достаточно rstrip
+    return line.partition("#")[0].rstrip()
 
 
 def country_code_to_flag(cc: str) -> str:
     """Двухбуквенный код страны (ISO 3166-1 alpha-2) -> эмодзи флаг (региональные индикаторы)."""
     if not cc or len(cc) != 2:
         return "\U0001f310"  # globe
+    cc = cc.upper()
+    flag = CC_TO_FLAG.get(cc)
+    if flag is not None:
+        return flag
+    # Код не из двух латинских букв - собираем по символам, пропуская остальные
     a = 0x1F1E6  # regional indicator A
-    return "".join(chr(a + ord(c) - ord("A")) for c in cc.upper() if "A" <= c <= "Z")
+    return "".join(chr(a + ord(c) - ord("A")) for c in cc if "A" <= c <= "Z")
 
 
 def get_host_from_link(link: str) -> str | None:
@@ -62,29 +125,20 @@ def get_host_from_link(link: str) -> str | None:
         parsed = parse_proxy_url(link)
         if parsed and isinstance(parsed.get("address"), str):
             return parsed["address"].strip()
-    # Fallback: ищем @host:port в типичных схемах
-    for prefix in ("vless://", "vmess://", "trojan://", "ss://", "hy2://", "hysteria2://", "hysteria://"):
-        if link.startswith(prefix):
-            rest = link[len(prefix) :].strip()
-            if "?" in rest:
-                rest = rest.split("?")[0]
-            if "@" in rest:
-                _, host_port = rest.rsplit("@", 1)
-                if ":" in host_port:
-                    return host_port.rpartition(":")[0].strip()
-                return host_port.strip()
-            if "://" in rest:
-                return rest.split("/")[0].strip()
-            break
-    return None
+    # Fallback: @host:port в типичных схемах одной регуляркой
+    m = _HOST_RE.match(link)
+    if m is None:
+        return None
+    return m.group(1).strip("[]").strip() or None
 
 
 def resolve_to_ip(host: str) -> str | None:
     """Возвращает IP для хоста или None при ошибке."""
     if not host:
         return None
-    if host.replace(".", "").isdigit():
-        return host
+    # IP-литерал (IPv4 или IPv6, в т.ч. в скобках) - без DNS
+    if _IPV4_RE.fullmatch(host) or _IPV6_RE.fullmatch(host):
+        return host.strip("[]")
     try:
         return socket.gethostbyname(host)
     except (socket.gaierror, OSError):
@@ -92,23 +146,176 @@ def resolve_to_ip(host: str) -> str | None:
 
 
 def fetch_country_for_ip(ip: str, cache: dict) -> str:
-    """Получает countryCode для IP через ip-api.com; использует cache."""
+    """Получает countryCode для IP через ip-api.com (GEO_API, формат line); использует cache.
+    В cache попадает только ответ сервиса (в т.ч. пустой код); при ошибке запроса - "" без записи в cache."""
     if ip in cache:
         return cache[ip]
     time.sleep(GEO_DELAY)
     try:
-        req = urllib.request.Request(GEO_API.format(ip=ip), headers={"User-Agent": "XRayCheck/1.0"})
-        with urllib.request.urlopen(req, timeout=GEO_TIMEOUT) as r:
-            import json
-            data = json.loads(r.read().decode())
-            cc = data.get("countryCode") or ""
-            cache[ip] = cc
-            return cc
+        r = _HTTP.request("GET", GEO_API.format(ip=ip), timeout=GEO_TIMEOUT)
+        if r.status != 200:
+            raise ValueError(f"HTTP {r.status}")
+        # Формат line: "US\n" без JSON; всё, что не код из двух букв, считаем неизвестной страной
+        cc = r.data.decode("ascii", errors="replace").strip()
+        if len(cc) != 2 or not cc.isalpha():
+            cc = ""
+        cache[ip] = cc
+        return cc
     except Exception:
-        cache[ip] = ""
         return ""
 
 
+def _load_cache(path: str, field: str, ttl: float) -> dict[str, dict]:
+    """Читает JSON-кэш {key: {field: str, "ts": unix_time}}; записи старше ttl и битые отбрасываются."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    min_ts = time.time() - ttl
+    return {
+        key: entry
+        for key, entry in data.items()
+        if isinstance(entry, dict)
+        and isinstance(entry.get(field), str)
+        and isinstance(entry.get("ts"), (int, float))
+        and entry["ts"] >= min_ts
+    }
+
+
+class GeoEntry(NamedTuple):
+    """Запись кэша стран: код страны и время получения (unix)."""
+
+    cc: str
+    ts: int
+
+
+def load_geo_cache(path: str) -> dict[str, GeoEntry]:
+    """Читает кэш стран с диска; записи старше GEO_CACHE_TTL отбрасываются. При ошибке - пустой кэш."""
+    entries = _load_cache(path, "cc", GEO_CACHE_TTL)
+    return {ip: GeoEntry(entry["cc"], int(entry["ts"])) for ip, entry in entries.items()}
+
+
+def save_geo_cache(path: str, cache: dict[str, GeoEntry]) -> None:
+    """Записывает кэш стран на диск в JSON-формате {"ip": {"cc": ..., "ts": ...}}."""
+    _save_cache(path, {ip: entry._asdict() for ip, entry in cache.items()})
+
+
+def _save_cache(path: str, cache: dict[str, dict]) -> None:
+    """Атомарно записывает JSON-кэш (временный файл + os.replace). Ошибки записи не критичны."""
+    tmp = f"{path}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(cache, f, separators=(",", ":"))
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+
+def fetch_countries_batch(ips: list[str], cache: dict) -> None:
+    """Заполняет cache (IP -> countryCode) для ips без записи в кэше: batch-запросы ip-api.com по GEO_BATCH_SIZE IP.
+    IP, по которым ответа нет (ошибка запроса), в cache не попадают."""
+    pending = [ip for ip in dict.fromkeys(ips) if ip not in cache]
+    for i in range(0, len(pending), GEO_BATCH_SIZE):
+        chunk = pending[i : i + GEO_BATCH_SIZE]
+        if i:
+            time.sleep(GEO_BATCH_DELAY)
+        try:
+            r = _HTTP.request(
+                "POST",
+                GEO_BATCH_API,
+                body=json.dumps([{"query": ip} for ip in chunk]).encode(),
+                headers={"User-Agent": "XRayCheck/1.0", "Content-Type": "application/json"},
+                timeout=GEO_TIMEOUT,
+            )
+            if r.status != 200:
+                raise ValueError(f"HTTP {r.status}")
+            data = json.loads(r.data)
+            for item in data:
+                if isinstance(item, dict) and item.get("query"):
+                    cache[item["query"]] = item.get("countryCode") or ""
+        except Exception:
+            # Временная ошибка не должна закрепляться в кэше как «страна неизвестна»
+            continue
+
+
+def resolve_to_ip_cached(host: str) -> str | None:
+    """resolve_to_ip с кэшем на время процесса: одинаковые хосты резолвятся один раз."""
+    try:
+        return _host_ip_cache[host]
+    except KeyError:
+        ip = _host_ip_cache[host] = resolve_to_ip(host)
+        return ip
+
+
+def resolve_hosts(hosts: list[str | None]) -> dict[str, str | None]:
+    """Хост -> IP для уникальных хостов: кэш процесса и кэш с диска, остальные - параллельно
+    (gethostbyname отпускает GIL). Новые успешные резолвы имён сохраняются на диск."""
+    unique = list(dict.fromkeys(host for host in hosts if host))
+    if not unique:
+        return {}
+    disk_cache = _load_cache(HOST_CACHE_PATH, "ip", HOST_CACHE_TTL)
+    for host in unique:
+        if host not in _host_ip_cache and host in disk_cache:
+            _host_ip_cache[host] = disk_cache[host]["ip"]
+    missing = [host for host in unique if host not in _host_ip_cache]
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(DNS_WORKERS, len(missing))) as ex:
+            resolved = dict(zip(missing, ex.map(resolve_to_ip_cached, missing)))
+        # Неудачный резолв может быть временным - на диск не пишем; IP-литералы не кэшируем
+        now = int(time.time())
+        new_entries = {host: {"ip": ip, "ts": now} for host, ip in resolved.items() if ip and ip != host}
+        if new_entries:
+            disk_cache.update(new_entries)
+            _save_cache(HOST_CACHE_PATH, disk_cache)
+    return {host: _host_ip_cache[host] for host in unique}
+
+
+def fetch_countries_single(ips: list[str], cache: dict) -> None:
+    """Дозапрашивает по одному (fetch_country_for_ip) IP, оставшиеся без ответа после batch, не больше GEO_SINGLE_MAX.
+    На первой ошибке запроса останавливается: сервис, скорее всего, недоступен и для остальных."""
+    pending = [ip for ip in dict.fromkeys(ips) if ip not in cache]
+    for ip in pending[:GEO_SINGLE_MAX]:
+        fetch_country_for_ip(ip, cache)
+        if ip not in cache:
+            break
+
+
+def lookup_countries(ips: list[str | None]) -> dict[str, str]:
+    """IP -> countryCode: сначала кэш с диска, остальные IP - batch-запросами, а не запросом на каждый IP.
+    IP, по которым batch не ответил (ошибка запроса), дозапрашиваются по одному."""
+    disk_cache = load_geo_cache(GEO_CACHE_PATH)
+    geo_cache = {ip: entry.cc for ip, entry in disk_cache.items()}
+    ips = [ip for ip in ips if ip]
+    fetch_countries_batch(ips, geo_cache)
+    fetch_countries_single(ips, geo_cache)
+    # В geo_cache только ответы сервиса (ошибки запросов не кэшируются) - на диск сохраняются все,
+    # включая пустой код (адрес без страны, например частная сеть)
+    now = int(time.time())
+    new_entries = {ip: GeoEntry(cc, now) for ip, cc in geo_cache.items() if ip not in disk_cache}
+    if new_entries:
+        disk_cache.update(new_entries)
+        save_geo_cache(GEO_CACHE_PATH, disk_cache)
+    return geo_cache
+
+
+def _write_bytes(path: Path, data: bytes) -> None:
+    """Записывает data в файл напрямую через os.write (без файлового объекта); неполные записи дописываются."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+    finally:
+        os.close(fd)
+
+
 def process_file(
     input_path: str,
     output_path: str | None,
@@ -120,23 +327,42 @@ def process_file(
         print(f"Error: file not found: {path}", file=sys.stderr)
         return 0
     out = Path(output_path) if output_path else path.parent / (path.stem + "_new" + path.suffix)
-    lines_in = path.read_text(encoding="utf-8").splitlines()
-    geo_cache: dict[str, str] = {}
-    result = []
-    for line in lines_in:
-        link = strip_comment_from_line(line)
-        if not link:
-            continue
-        if add_comment:
-            host = get_host_from_link(link)
-            ip = resolve_to_ip(host) if host else None
-            cc = fetch_country_for_ip(ip, geo_cache) if ip else ""
-            flag = country_code_to_flag(cc)
-            link = f"{link}#{flag} {get_auto_comment().strip()}"
-        result.append(link)
-    out.write_text("\n".join(result) + ("\n" if result else ""), encoding="utf-8")
-    print(f"Processed: {len(lines_in)} lines -> {len(result)} with new comment. Output: {out}")
-    return len(result)
+    # Вход читается потоково блоками (буфер 128 КБ), а не целиком; в памяти остаются только ссылки.
+    # Комментарии в блоке срезаются одной регуляркой (построчно - как strip_comment_from_line)
+    n_lines = 0
+    links: list[str] = []
+    with open(path, encoding="utf-8", buffering=_READ_BUFFER) as f:
+        for block in read_blocks(f, _READ_BUFFER):
+            lines = block.splitlines()
+            n_lines += len(lines)
+            stripped = _COMMENT_RE.sub(r"\1", "\n".join(lines))
+            links.extend(filter(None, map(str.strip, stripped.split("\n"))))
+    # Дальше конвейер по этапам: каждый этап - один проход по всему массиву
+    if not add_comment:
+        # Только удаление комментариев: без разбора хостов, DNS, geo и кэшей - сразу вывод
+        _write_bytes(out, ("\n".join(links) + ("\n" if links else "")).encode("utf-8"))
+        print(f"Processed: {n_lines} lines -> {len(links)} with new comment. Output: {out}")
+        return len(links)
+    # Повторяющиеся ссылки разбираются один раз; в выводе остаются все строки в исходном порядке
+    unique_links = list(dict.fromkeys(links))
+    hosts = list(map(get_host_from_link, unique_links))
+    host_to_ip = resolve_hosts(hosts)
+    ips = [host_to_ip.get(host) for host in hosts]
+    ip_to_cc = lookup_countries(ips)
+    flags = [country_code_to_flag(ip_to_cc.get(ip, "")) for ip in ips]
+    # Текст комментария за время запуска не меняется - берём из окружения один раз
+    auto_comment = get_auto_comment().strip()
+    tagged = {
+        link: f"{link}#{flag} {auto_comment}\n".encode("utf-8") for link, flag in zip(unique_links, flags)
+    }
+    # Вывод собирается сразу в байтах, без промежуточного списка строк и общего join
+    buf = bytearray()
+    extend = buf.extend
+    for link in links:
+        extend(tagged[link])
+    _write_bytes(out, buf)
+    print(f"Processed: {n_lines} lines -> {len(links)} with new comment. Output: {out}")
+    return len(links)
 
 
 def main():